@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 """
 HotelJT – Gestão de Hotel (22 quartos) em um único arquivo
-Stack: Python 3.10+, Flask, SQLAlchemy, SQLite.
+Stack: Python 3.10+, Flask 2.3+, Flask-SQLAlchemy 3+, SQLAlchemy 2.0+, SQLite 3.35+
+(UPDATE ... RETURNING nas transições, coluna gerada de diárias e FTS5 na busca de hóspedes).
 
 Funcionalidades principais:
 - Dashboard com ocupação do dia e receita do mês
@@ -14,7 +15,8 @@ Funcionalidades principais:
 
 Como rodar (Ubuntu):
   python3 -m venv .venv && source .venv/bin/activate
-  pip install Flask SQLAlchemy python-dateutil
+  pip install "Flask>=2.3" "Flask-SQLAlchemy>=3" "SQLAlchemy>=2.0" python-dateutil
+  python3 -c "import sqlite3; print(sqlite3.sqlite_version)"  # precisa ser 3.35 ou mais novo
   export FLASK_APP=app.py FLASK_ENV=development
   python app.py  # primeira execução cria o banco e os 22 quartos
   # depois acesse http://127.0.0.1:5000
@@ -23,27 +25,85 @@ Banco: hotelJT.db (SQLite) criado no diretório atual.
 """
 
 from __future__ import annotations
+import hashlib
+import hmac
 import os
+import queue
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from datetime import date, datetime, timedelta
 from decimal import Decimal
+from typing import Any, Callable
 
 from dateutil import tz
-from flask import Flask, redirect, render_template_string, request, url_for, flash
+from flask import (
+    Flask, abort, flash, g, get_flashed_messages, has_request_context, make_response, redirect, render_template,
+    request, session, stream_template, url_for,
+)
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, and_, or_, UniqueConstraint
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import (
+    event, extract, func, inspect, literal, select, text, type_coerce, update, and_, or_, cast, column, Integer,
+    UniqueConstraint,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload
+from sqlalchemy.pool import QueuePool
 
 APP_TZ = tz.gettz(os.getenv("TZ", "America/Sao_Paulo"))
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///hotelJT.db")
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
 
 def today() -> date:
+    # Dentro de uma requisição usa a data fixada em before_request (uma chamada a now() por requisição)
+    if has_request_context() and "today" in g:
+        return g.today
     return datetime.now(tz=APP_TZ).date()
 
+def month_bounds(d: date) -> tuple[date, date]:
+    # [primeiro dia do mês, primeiro dia do mês seguinte)
+    y, m = (d.year, d.month + 1) if d.month < 12 else (d.year + 1, 1)
+    return d.replace(day=1), date(y, m, 1)
+
 app = Flask(__name__)
 app.config.update(
-    SQLALCHEMY_DATABASE_URI=os.getenv("DATABASE_URL", "sqlite:///hotelJT.db"),
+    SQLALCHEMY_DATABASE_URI=DATABASE_URL,
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
     SECRET_KEY=os.getenv("SECRET_KEY", "dev-key-change-me"),
+    SQLALCHEMY_ENGINE_OPTIONS={
+        "poolclass": QueuePool,
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    },
+)
+
+# WAL permite leituras concorrentes com escrita; synchronous=NORMAL evita fsync a cada commit
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",
 )
 
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
 db = SQLAlchemy(app)
 
 # --------------------------
@@ -73,6 +133,31 @@ class Guest(db.Model):
     def __repr__(self):
         return f"<Guest {self.name}>"
 
+def stay_nights(check_in: date, check_out: date) -> int:
+    # Garante que mesmo check-in e check-out no mesmo dia conte como 1 noite
+    return max((check_out - check_in).days, 1)
+
+# Mesma regra de stay_nights() calculada pelo banco. No SQLite a coluna é VIRTUAL, pois
+# ALTER TABLE só consegue adicionar colunas geradas virtuais em bancos já existentes.
+NIGHTS_SQL = (
+    "max(CAST(julianday(check_out) - julianday(check_in) AS INTEGER), 1)"
+    if IS_SQLITE
+    else "greatest(check_out - check_in, 1)"
+)
+
+def sql_greatest(*args):
+    return func.max(*args) if IS_SQLITE else func.greatest(*args)
+
+def sql_days_between(start, end):
+    # (end - start).days calculado pelo banco
+    if IS_SQLITE:
+        return cast(func.julianday(end) - func.julianday(start), Integer)
+    return cast(end - start, Integer)
+
+def sql_nights(check_in, check_out):
+    # stay_nights() em SQL
+    return sql_greatest(sql_days_between(check_in, check_out), 1)
+
 class Booking(db.Model):
     __tablename__ = "bookings"
     id = db.Column(db.Integer, primary_key=True)
@@ -83,36 +168,254 @@ class Booking(db.Model):
     status = db.Column(db.String(20), default="reservado", nullable=False)  # reservado|checkin|checkout|cancelado
     notes = db.Column(db.Text, nullable=True)
     total_amount = db.Column(db.Numeric(10, 2), default=Decimal("0.00"), nullable=False)
+    rate = db.Column(db.Numeric(10, 2), nullable=False)  # diária do quarto congelada na reserva
+    nights = db.Column(db.Integer, db.Computed(NIGHTS_SQL, persisted=not IS_SQLITE))
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(tz=APP_TZ))
 
     room = db.relationship(Room)
     guest = db.relationship(Guest)
 
-    def nights(self) -> int:
-        # Garante que mesmo check-in e check-out no mesmo dia conte como 1 noite
-        return max((self.check_out - self.check_in).days, 1)
+    # Índices para status do quarto, conflito de reservas, dashboard e reconstrução dos agregados
+    # (status + datas cobre tanto a faixa por check-in quanto a sobreposição de períodos)
+    __table_args__ = (
+        db.Index("ix_bookings_room_status_dates", "room_id", "status", "check_in", "check_out"),
+        db.Index("ix_bookings_status_dates", "status", "check_in", "check_out"),
+    )
 
     def compute_amount(self) -> Decimal:
-        return (self.room.rate or Decimal("0.00")) * self.nights()
+        return (self.rate or Decimal("0.00")) * stay_nights(self.check_in, self.check_out)
+
+class RevenueByMonth(db.Model):
+    # Receita de check-outs agregada por mês, atualizada incrementalmente no check-out
+    __tablename__ = "bookings_revenue_by_month"
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    revenue = db.Column(db.Numeric(12, 2), default=Decimal("0.00"), nullable=False)
+    checkouts = db.Column(db.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"<RevenueByMonth {self.year}-{self.month:02d}>"
+
+class DailyOccupancy(db.Model):
+    # Quartos ocupados por dia e receita pela data de check-out, mantidos a cada mudança de reserva
+    __tablename__ = "daily_occupancy"
+    day = db.Column(db.Date, primary_key=True)
+    rooms_occupied = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Numeric(12, 2), default=Decimal("0.00"), nullable=False)
+
+    def __repr__(self):
+        return f"<DailyOccupancy {self.day}>"
+
+def stay_days(check_in: date, check_out: date):
+    # Noites efetivamente ocupadas: [check_in, check_out)
+    return (check_in + timedelta(days=i) for i in range((check_out - check_in).days))
+
+def upsert(model):
+    insert = pg_insert if db.engine.dialect.name == "postgresql" else sqlite_insert
+    return insert(model)
+
+def add_month_revenue(checkout_date: date, amount: Decimal, checkouts: int = 1) -> None:
+    stmt = upsert(RevenueByMonth).values(
+        year=checkout_date.year, month=checkout_date.month, revenue=amount, checkouts=checkouts
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["year", "month"],
+        set_={
+            "revenue": RevenueByMonth.revenue + stmt.excluded.revenue,
+            "checkouts": RevenueByMonth.checkouts + stmt.excluded.checkouts,
+        },
+    )
+    db.session.execute(stmt)
+
+def add_daily(rows: list[dict]) -> None:
+    stmt = upsert(DailyOccupancy)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["day"],
+        set_={
+            "rooms_occupied": DailyOccupancy.rooms_occupied + stmt.excluded.rooms_occupied,
+            "revenue": DailyOccupancy.revenue + stmt.excluded.revenue,
+        },
+    )
+    db.session.execute(stmt, rows)
+
+def apply_booking_effect(check_in: date, check_out: date, status: str, total_amount: Decimal, sign: int) -> None:
+    # Soma (sign=1) ou retira (sign=-1) a contribuição de uma reserva nos agregados.
+    # Reservas em checkin/checkout ocupam [check_in, check_out); checkout também gera receita.
+    if status not in ("checkin", "checkout"):
+        return
+    rows = [{"day": day, "rooms_occupied": sign, "revenue": 0} for day in stay_days(check_in, check_out)]
+    if status == "checkout":
+        rows.append({"day": check_out, "rooms_occupied": 0, "revenue": sign * total_amount})
+        add_month_revenue(check_out, sign * total_amount, checkouts=sign)
+    if rows:
+        add_daily(rows)
+
+def rebuild_rollups() -> None:
+    RevenueByMonth.query.delete()
+    DailyOccupancy.query.delete()
+    year, month = extract("year", Booking.check_out), extract("month", Booking.check_out)
+    rows = (
+        db.session.query(year, month, func.sum(Booking.total_amount), func.count(Booking.id))
+        .filter(Booking.status == "checkout")
+        .group_by(year, month)
+        .all()
+    )
+    db.session.add_all(
+        RevenueByMonth(year=y, month=m, revenue=revenue, checkouts=n) for y, m, revenue, n in rows
+    )
+    # Ocupação diária: percorre as reservas uma única vez guardando só as variações
+    # (+1 na entrada, -1 na saída); a contagem de cada dia sai da soma acumulada.
+    # Dias como ordinais (int): comparações e intervalos sem objetos date/timedelta no laço
+    delta: dict[int, int] = defaultdict(int)
+    revenue_by_day: dict[int, Decimal] = defaultdict(Decimal)
+    bookings = select(Booking.check_in, Booking.check_out, Booking.status, Booking.total_amount).where(
+        Booking.status.in_(["checkin", "checkout"])
+    )
+    # yield_per: o ORM entrega lotes de 1000 linhas em vez de carregar o resultado inteiro;
+    # stream_results: no Postgres o driver também lê de um cursor no servidor (no SQLite não muda nada)
+    rows = db.session.execute(bookings, execution_options={"stream_results": True, "yield_per": 1000})
+    for check_in, check_out, status, total_amount in rows:
+        ci, co = check_in.toordinal(), check_out.toordinal()
+        if co > ci:
+            delta[ci] += 1
+            delta[co] -= 1
+        if status == "checkout":
+            revenue_by_day[co] += total_amount
+    occupied: dict[int, int] = {}
+    running = 0
+    points = sorted(delta)
+    for day, next_day in zip(points, points[1:]):
+        running += delta[day]
+        if running:
+            occupied.update(dict.fromkeys(range(day, next_day), running))
+    db.session.add_all(
+        DailyOccupancy(
+            day=date.fromordinal(day),
+            rooms_occupied=occupied.get(day, 0),
+            revenue=revenue_by_day.get(day, Decimal("0.00")),
+        )
+        for day in occupied.keys() | revenue_by_day.keys()
+    )
+    db.session.commit()
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recalcula bookings_revenue_by_month e daily_occupancy a partir das reservas."""
+    rebuild_rollups()
+    print("Agregados recalculados.")
+
+# Índice de busca textual (SQLite FTS5) espelhando a tabela guests via triggers
+GUESTS_FTS_DDL = (
+    "CREATE VIRTUAL TABLE guests_fts USING fts5(name, document, phone, email, "
+    "content='guests', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER guests_fts_ai AFTER INSERT ON guests BEGIN "
+    "INSERT INTO guests_fts(rowid, name, document, phone, email) "
+    "VALUES (new.id, new.name, new.document, new.phone, new.email); END",
+    "CREATE TRIGGER guests_fts_ad AFTER DELETE ON guests BEGIN "
+    "INSERT INTO guests_fts(guests_fts, rowid, name, document, phone, email) "
+    "VALUES ('delete', old.id, old.name, old.document, old.phone, old.email); END",
+    "CREATE TRIGGER guests_fts_au AFTER UPDATE ON guests BEGIN "
+    "INSERT INTO guests_fts(guests_fts, rowid, name, document, phone, email) "
+    "VALUES ('delete', old.id, old.name, old.document, old.phone, old.email); "
+    "INSERT INTO guests_fts(rowid, name, document, phone, email) "
+    "VALUES (new.id, new.name, new.document, new.phone, new.email); END",
+    "INSERT INTO guests_fts(guests_fts) VALUES ('rebuild')",
+)
 
 # --------------------------
 # DB bootstrap
 # --------------------------
+ROOM_SEED = [
+    *((str(n), "Single", Decimal("110.00")) for n in range(101, 106)),
+    *((str(n), "Duplo", Decimal("200.00")) for n in range(106, 116)),
+    *((str(n), "Triplo", Decimal("290.00")) for n in range(116, 121)),
+    *((str(n), "Quadruplo", Decimal("360.00")) for n in range(121, 123)),
+]
+
 with app.app_context():
+    # A tabela diária é criada junto com a primeira reconstrução dos agregados: serve de marcador
+    rollups_missing = not inspect(db.engine).has_table(DailyOccupancy.__tablename__)
     db.create_all()
+    # create_all não altera tabelas já existentes: cria os índices que faltarem em bancos antigos
+    booking_columns = {c["name"] for c in inspect(db.engine).get_columns("bookings")}
+    # Bancos anteriores à diária congelada na reserva: cria a coluna e usa a diária atual do quarto
+    if "rate" not in booking_columns:
+        db.session.execute(text("ALTER TABLE bookings ADD COLUMN rate NUMERIC(10, 2) NOT NULL DEFAULT 0"))
+        db.session.execute(text("UPDATE bookings SET rate = (SELECT rate FROM rooms WHERE rooms.id = bookings.room_id)"))
+        db.session.commit()
+    if "nights" not in booking_columns:
+        storage = "VIRTUAL" if IS_SQLITE else "STORED"
+        db.session.execute(text(f"ALTER TABLE bookings ADD COLUMN nights INTEGER GENERATED ALWAYS AS ({NIGHTS_SQL}) {storage}"))
+        db.session.commit()
+    for index in Booking.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    # Substituído por ix_bookings_status_dates, que tem as mesmas colunas iniciais
+    db.session.execute(text("DROP INDEX IF EXISTS ix_bookings_status_checkin"))
+    # Nenhuma consulta filtra reservas por (status, check_out): receita vem dos agregados
+    db.session.execute(text("DROP INDEX IF EXISTS ix_bookings_status_checkout"))
+    db.session.commit()
+    if IS_SQLITE and not inspect(db.engine).has_table("guests_fts"):
+        for ddl in GUESTS_FTS_DDL:
+            db.session.execute(text(ddl))
+        db.session.commit()
+    # Bancos anteriores às tabelas de agregados: popula uma única vez a partir do histórico
+    # (depois disso, "flask rebuild-rollups" recalcula sob demanda)
+    if rollups_missing and Booking.query.filter(Booking.status.in_(["checkin", "checkout"])).first():
+        rebuild_rollups()
     # Seed 22 rooms with correct types and rates
     if Room.query.count() == 0:
-        rooms = []
-        for n in range(101, 106): rooms.append(Room(number=str(n), room_type="Single", rate=Decimal("110.00")))
-        for n in range(106, 116): rooms.append(Room(number=str(n), room_type="Duplo", rate=Decimal("200.00")))
-        for n in range(116, 121): rooms.append(Room(number=str(n), room_type="Triplo", rate=Decimal("290.00")))
-        for n in range(121, 123): rooms.append(Room(number=str(n), room_type="Quadruplo", rate=Decimal("360.00")))
-        db.session.add_all(rooms)
+        db.session.bulk_save_objects([Room(number=n, room_type=t, rate=r) for n, t, r in ROOM_SEED])
         db.session.commit()
 
 # --------------------------
 # Helpers
 # --------------------------
+# Cache em memória do processo: chave -> (expira_em, valor)
+_CACHE: dict[str, tuple[float, Any]] = {}
+bookings_version = 0
+
+def cached(key: str, ttl: float, fn: Callable[[], Any]) -> Any:
+    now = time.monotonic()
+    hit = _CACHE.get(key)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    value = fn()
+    _CACHE[key] = (now + ttl, value)
+    return value
+
+def invalidate(pattern: str) -> None:
+    # Aceita chave exata ou prefixo terminado em "*" (ex.: "dash:*")
+    prefix = pattern[:-1] if pattern.endswith("*") else None
+    for key in list(_CACHE):
+        if key == pattern or (prefix is not None and key.startswith(prefix)):
+            _CACHE.pop(key, None)
+
+def bookings_changed() -> None:
+    # Chamado após qualquer commit que altere reservas
+    global bookings_version
+    bookings_version += 1
+    invalidate("dash:*")
+
+def all_rooms_cached() -> list:
+    # Quartos não mudam pela aplicação; quem vier a alterá-los deve chamar invalidate("form:rooms")
+    return cached(
+        "form:rooms",
+        float("inf"),
+        lambda: db.session.query(Room.id, Room.number, Room.room_type, Room.rate).order_by(Room.number.asc()).all(),
+    )
+
+def get_total_rooms() -> int:
+    # Mesmo cache da lista de quartos: sem SELECT COUNT(*) por relatório
+    return len(all_rooms_cached())
+
+def all_guests_cached() -> list:
+    # Hóspedes mudam com mais frequência: TTL curto além da invalidação no cadastro/edição
+    return cached(
+        "form:guests",
+        30,
+        lambda: db.session.query(Guest.id, Guest.name, Guest.document).order_by(Guest.name.asc()).all(),
+    )
+
 STATUS_BADGE = {
     "livre": "bg-green-100 text-green-800",
     "reservado": "bg-yellow-100 text-yellow-800",
@@ -121,237 +424,206 @@ STATUS_BADGE = {
     "cancelado": "bg-red-100 text-red-800",
 }
 
-def room_status(room: Room, reference: date | None = None) -> str:
-    reference = reference or today()
-    active = Booking.query.filter(
-        Booking.room_id == room.id,
+def room_rate(room_id: int) -> Decimal | None:
+    return db.session.query(Room.rate).filter(Room.id == room_id).scalar()
+
+def parse_date(value: str | None) -> date | None:
+    # Datas dos formulários (input type=date) chegam em ISO: YYYY-MM-DD
+    try:
+        return date.fromisoformat(value or "")
+    except ValueError:
+        return None
+
+def guest_search_filter(q: str):
+    # Cada palavra vira um prefixo FTS5 ("ana"* "sou"*); sem FTS, cai no ILIKE
+    words = re.findall(r"\w+", q)
+    if not IS_SQLITE or not words:
+        like = f"%{q}%"
+        return or_(Guest.name.ilike(like), Guest.document.ilike(like))
+    match = " ".join(f'"{w}"*' for w in words)
+    matching_ids = (
+        text("SELECT rowid FROM guests_fts WHERE guests_fts MATCH :match")
+        .bindparams(match=match)
+        .columns(column("rowid", Integer))
+    )
+    return Guest.id.in_(matching_ids)
+
+def active_booking_filter(reference: date):
+    # Reserva que ocupa o quarto na data de referência (usado no mapa e no detalhe)
+    return and_(
         Booking.status.in_(["reservado", "checkin"]),
         Booking.check_in <= reference,
         Booking.check_out > reference,
-    ).order_by(Booking.check_in.desc()).first()
-    if active:
-        return "checkin" if active.status == "checkin" else "reservado"
-    return "livre"
+    )
+
+def active_booking_order() -> tuple:
+    # Mais de uma reserva ativa no dia: check-in tem prioridade, depois a entrada mais recente
+    return (Booking.status == "checkin").desc(), Booking.check_in.desc()
+
+def booking_conflict_filter(room_id: int, check_in: date, check_out: date, exclude_id: int | None = None):
+    # Reservas ativas do quarto que se sobrepõem ao período [check_in, check_out)
+    predicate = and_(
+        Booking.room_id == room_id,
+        Booking.status.in_(["reservado", "checkin"]),
+        Booking.check_in < check_out,
+        Booking.check_out > check_in,
+    )
+    if exclude_id is not None:
+        predicate = and_(Booking.id != exclude_id, predicate)
+    return predicate
+
+def conflicting_guest(room_id: int, check_in: date, check_out: date, exclude_id: int | None = None) -> str | None:
+    # Uma única consulta projetada: detecta o conflito e já traz o nome do hóspede
+    conflict = (
+        db.session.query(Booking.id, Guest.name)
+        .join(Guest, Booking.guest_id == Guest.id)
+        .filter(booking_conflict_filter(room_id, check_in, check_out, exclude_id))
+        .first()
+    )
+    return conflict.name if conflict else None
+
+def status_from_booking(booking_status: str | None) -> str:
+    if booking_status is None:
+        return "livre"
+    return "checkin" if booking_status == "checkin" else "reservado"
+
+def room_status(room: Room, reference: date | None = None) -> str:
+    reference = reference or today()
+    active = (
+        db.session.query(Booking.status)
+        .filter(Booking.room_id == room.id, active_booking_filter(reference))
+        .order_by(*active_booking_order())
+        .first()
+    )
+    return status_from_booking(active.status if active else None)
+
+def rooms_with_status(reference: date | None = None) -> list[tuple]:
+    # Um único SELECT com LEFT JOIN em vez de uma consulta por quarto (N+1),
+    # trazendo apenas as colunas usadas no mapa de quartos: (quarto, status, classe CSS)
+    reference = reference or today()
+    rows = (
+        db.session.query(Room.id, Room.number, Room.room_type, Room.rate, Booking.status)
+        .outerjoin(Booking, and_(Booking.room_id == Room.id, active_booking_filter(reference)))
+        .order_by(Room.number.asc(), *active_booking_order())
+        .all()
+    )
+    items: dict[int, tuple] = {}
+    for row in rows:
+        # Linhas já vêm na ordem de active_booking_order(): a primeira de cada quarto define o status
+        if row.id not in items:
+            st = status_from_booking(row.status)
+            items[row.id] = (row, st, STATUS_BADGE[st])
+    return list(items.values())
 
 # --------------------------
-# Templates (Tailwind via CDN)
+# Templates (Jinja em templates/, Tailwind via CDN)
+# O bytecode compilado fica em disco: reinícios e novos workers não recompilam os templates
+JINJA_CACHE_DIR = os.path.join(app.instance_path, "jinja_cache")
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
 # --------------------------
-BASE_HTML = """
-<!doctype html>
-<html lang="pt-br">
-  <head>
-    <meta charset="utf-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <title>HotelJT</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-  </head>
-  <body class="bg-slate-50 text-slate-900">
-    <nav class="bg-slate-900 text-white px-4 py-3 flex gap-4 items-center">
-      <a href="{{ url_for('dashboard') }}" class="font-bold">HotelJT</a>
-      <a href="{{ url_for('rooms') }}" class="hover:underline">Quartos</a>
-      <a href="{{ url_for('guests') }}" class="hover:underline">Hóspedes</a>
-      <a href="{{ url_for('bookings') }}" class="hover:underline">Reservas</a>
-      <a href="{{ url_for('reports') }}" class="hover:underline">Relatórios</a>
-      <span class="ml-auto text-sm opacity-80">{{ now.strftime('%d/%m/%Y') }}</span>
-    </nav>
-    <main class="p-4 max-w-6xl mx-auto">
-      {% with messages = get_flashed_messages() %}
-        {% if messages %}
-          <div class="mb-4">{% for m in messages %}
-            <div class="p-3 rounded bg-emerald-100 text-emerald-900 mb-2">{{ m }}</div>
-          {% endfor %}</div>
-        {% endif %}
-      {% endwith %}
-      {{ content|safe }}
-    </main>
-  </body>
-</html>
-"""
+def csrf_token() -> str:
+    if "csrf_token" not in session:
+        session["csrf_token"] = secrets.token_urlsafe(32)
+    return session["csrf_token"]
+
+def check_csrf() -> None:
+    expected = session.get("csrf_token")
+    if not expected or not hmac.compare_digest(request.form.get("csrf_token", ""), expected):
+        abort(400)
+
+app.jinja_env.globals["csrf_token"] = csrf_token
+
+def stream_page(template: str, **context):
+    # Resposta enviada em partes à medida que o Jinja consome o iterador de linhas.
+    # As mensagens flash são lidas antes: a sessão é gravada antes de o corpo ser transmitido.
+    get_flashed_messages()
+    return stream_template(template, **context)
 
 # --------------------------
 # Views
 # --------------------------
+@app.before_request
+def stamp_now():
+    g.now = datetime.now(tz=APP_TZ)
+    g.today = g.now.date()
+    g.month_bounds = month_bounds(g.today)
+
 @app.context_processor
 def inject_now():
-    return {"now": datetime.now(tz=APP_TZ)}
+    return {"now": g.get("now") or datetime.now(tz=APP_TZ)}
 
-@app.route("/")
-def dashboard():
-    d = today()
-    occupied = (
+def dashboard_summary(d: date) -> dict:
+    # Os três indicadores do topo em um único SELECT (subconsultas escalares)
+    metrics = db.session.query(
         db.session.query(func.count(Booking.id))
-        .filter(Booking.status.in_(["checkin"]), Booking.check_in <= d, Booking.check_out > d)
-        .scalar()
-    )
-    total_rooms = Room.query.count()
-
-    start_month = d.replace(day=1)
-    next_month = (start_month + timedelta(days=32)).replace(day=1)
-    revenue = (
-        db.session.query(func.coalesce(func.sum(Booking.total_amount), 0))
-        .filter(Booking.status == "checkout", Booking.check_out >= start_month, Booking.check_out < next_month)
-        .scalar()
-    )
-
+        .filter(Booking.status == "checkin", Booking.check_in <= d, Booking.check_out > d)
+        .scalar_subquery()
+        .label("occupied"),
+        db.session.query(func.count(Room.id)).scalar_subquery().label("total_rooms"),
+        db.session.query(func.coalesce(func.sum(RevenueByMonth.revenue), 0))
+        .filter(RevenueByMonth.year == d.year, RevenueByMonth.month == d.month)
+        .scalar_subquery()
+        .label("revenue"),
+    ).one()
+
+    # Tuplas (e não objetos ORM) para poderem ficar no cache entre requisições
     upcoming = (
-        Booking.query.filter(Booking.status == "reservado", Booking.check_in >= d)
+        db.session.query(
+            Booking.id, Booking.check_in, Room.number.label("room_number"), Guest.name.label("guest_name")
+        )
+        .join(Room, Booking.room_id == Room.id)
+        .join(Guest, Booking.guest_id == Guest.id)
+        .filter(Booking.status == "reservado", Booking.check_in >= d)
         .order_by(Booking.check_in.asc())
         .limit(5)
         .all()
     )
+    return {
+        "occupied": metrics.occupied,
+        "total_rooms": metrics.total_rooms,
+        "revenue": float(metrics.revenue or 0),
+        "upcoming": upcoming,
+    }
 
-    content = render_template_string(
-        """
-        <div class="grid md:grid-cols-3 gap-4">
-          <div class="p-4 rounded-2xl bg-white shadow">
-            <div class="text-sm opacity-70">Ocupação hoje</div>
-            <div class="text-3xl font-bold">{{ occupied }}/{{ total_rooms }}</div>
-          </div>
-          <div class="p-4 rounded-2xl bg-white shadow">
-            <div class="text-sm opacity-70">Receita do mês</div>
-            <div class="text-3xl font-bold">R$ {{ '%.2f'|format(revenue) }}</div>
-          </div>
-        </div>
-
-        <h2 class="mt-8 mb-2 font-semibold text-lg">Próximos check-ins</h2>
-        <div class="bg-white shadow rounded-2xl overflow-hidden">
-          <table class="w-full text-sm">
-            <thead class="bg-slate-100">
-              <tr><th class="p-2 text-left">Data</th><th class="p-2 text-left">Quarto</th><th class="p-2 text-left">Hóspede</th><th></th></tr>
-            </thead>
-            <tbody>
-              {% for b in upcoming %}
-              <tr class="border-t">
-                <td class="p-2">{{ b.check_in.strftime('%d/%m/%Y') }}</td>
-                <td class="p-2">{{ b.room.number }}</td>
-                <td class="p-2">{{ b.guest.name }}</td>
-                <td class="p-2"><a class="underline" href="{{ url_for('booking_detail', booking_id=b.id) }}">Abrir</a></td>
-              </tr>
-              {% else %}
-              <tr><td class="p-2" colspan="4">Sem reservas futuras.</td></tr>
-              {% endfor %}
-            </tbody>
-          </table>
-        </div>
-        """,
-        occupied=occupied,
-        total_rooms=total_rooms,
-        revenue=float(revenue or 0),
-        upcoming=upcoming
-    )
-    return render_template_string(BASE_HTML, content=content)
+@app.route("/")
+def dashboard():
+    d = today()
+    # A versão entra na chave: um cálculo iniciado antes de uma alteração nunca é servido depois dela
+    summary = cached(f"dash:{d}:{bookings_version}", 60, lambda: dashboard_summary(d))
+
+    return render_template("dashboard.html", **summary)
 
 @app.route("/quartos")
 def rooms():
-    all_rooms = Room.query.order_by(Room.number.asc()).all()
-    items = [(r, room_status(r)) for r in all_rooms]
-    content = render_template_string(
-        """
-        <div class="flex items-center mb-4">
-          <h1 class="text-xl font-semibold">Quartos</h1>
-          <a href="{{ url_for('new_booking') }}" class="ml-auto inline-block px-3 py-2 bg-slate-900 text-white rounded-xl shadow">Nova reserva</a>
-        </div>
-        <div class="grid grid-cols-2 md:grid-cols-4 lg:grid-cols-7 gap-3">
-          {% for room, st in items %}
-            <a href="{{ url_for('room_detail', room_id=room.id) }}" class="p-3 rounded-2xl shadow bg-white">
-              <div class="text-sm opacity-60">Quarto</div>
-              <div class="text-2xl font-bold">{{ room.number }}</div>
-              <div class="mt-2 text-xs inline-block px-2 py-1 rounded {{ STATUS_BADGE[st] }}">{{ st }}</div>
-              <div class="text-xs opacity-70 mt-1">R$ {{ '%.2f'|format(room.rate) }}/noite</div>
-              <div class="text-xs opacity-70">{{ room.room_type }}</div>
-            </a>
-          {% endfor %}
-        </div>
-        """,
-        items=items,
-        STATUS_BADGE=STATUS_BADGE,
-    )
-    return render_template_string(BASE_HTML, content=content)
+    items = rooms_with_status()
+    return render_template("rooms.html", items=items)
 
 @app.route("/quartos/<int:room_id>")
 def room_detail(room_id: int):
     room = Room.query.get_or_404(room_id)
     recent = (
-        Booking.query.filter(Booking.room_id == room.id)
+        Booking.query.options(joinedload(Booking.guest))
+        .filter(Booking.room_id == room.id)
         .order_by(Booking.check_in.desc())
         .limit(10)
         .all()
     )
     st = room_status(room)
-    content = render_template_string(
-        """
-        <div class="flex items-center mb-4">
-          <h1 class="text-xl font-semibold">Quarto {{ room.number }}</h1>
-          <a href="{{ url_for('new_booking', room_id=room.id) }}" class="ml-auto inline-block px-3 py-2 bg-slate-900 text-white rounded-xl shadow">Reservar</a>
-        </div>
-        <div class="bg-white rounded-2xl shadow p-4">
-          <div class="flex gap-6">
-            <div><div class="text-sm opacity-60">Tipo</div><div class="font-semibold">{{ room.room_type }}</div></div>
-            <div><div class="text-sm opacity-60">Diária</div><div class="font-semibold">R$ {{ '%.2f'|format(room.rate) }}</div></div>
-            <div><div class="text-sm opacity-60">Status</div><div class="text-xs inline-block px-2 py-1 rounded {{ STATUS_BADGE[st] }}">{{ st }}</div></div>
-          </div>
-        </div>
-        <h2 class="mt-6 mb-2 font-semibold">Últimas reservas</h2>
-        <div class="bg-white shadow rounded-2xl overflow-hidden">
-          <table class="w-full text-sm">
-            <thead class="bg-slate-100"><tr><th class="p-2 text-left">Período</th><th class="p-2 text-left">Hóspede</th><th class="p-2 text-left">Status</th><th></th></tr></thead>
-            <tbody>
-            {% for b in recent %}
-              <tr class="border-t">
-                <td class="p-2">{{ b.check_in.strftime('%d/%m/%Y') }} → {{ b.check_out.strftime('%d/%m/%Y') }}</td>
-                <td class="p-2">{{ b.guest.name }}</td>
-                <td class="p-2">{{ b.status }}</td>
-                <td class="p-2"><a class="underline" href="{{ url_for('booking_detail', booking_id=b.id) }}">Abrir</a></td>
-              </tr>
-            {% else %}
-              <tr><td class="p-2" colspan="4">Sem histórico.</td></tr>
-            {% endfor %}
-            </tbody>
-          </table>
-        </div>
-        """,
-        room=room, STATUS_BADGE=STATUS_BADGE, st=st, recent=recent
-    )
-    return render_template_string(BASE_HTML, content=content)
+    return render_template("room_detail.html", room=room, st=st, badge=STATUS_BADGE[st], recent=recent)
 
 # -------------------------- Hóspedes --------------------------
 @app.route("/hospedes")
 def guests():
     q = request.args.get("q", "")
-    base = Guest.query
+    base = db.session.query(Guest.id, Guest.name, Guest.document, Guest.phone, Guest.email)
     if q:
-        like = f"%{q}%"
-        base = base.filter(or_(Guest.name.ilike(like), Guest.document.ilike(like)))
-    gs = base.order_by(Guest.name.asc()).limit(200).all()
-
-    content = render_template_string(
-        """
-        <div class="flex items-center mb-4">
-          <h1 class="text-xl font-semibold">Hóspedes</h1>
-          <form class="ml-4" method="get"><input name="q" value="{{ request.args.get('q','') }}" placeholder="Buscar" class="px-3 py-2 border rounded-xl"></form>
-          <a href="{{ url_for('new_guest') }}" class="ml-auto inline-block px-3 py-2 bg-slate-900 text-white rounded-xl shadow">Novo hóspede</a>
-        </div>
-        <div class="bg-white shadow rounded-2xl overflow-hidden">
-          <table class="w-full text-sm">
-            <thead class="bg-slate-100"><tr><th class="p-2 text-left">Nome</th><th class="p-2 text-left">Documento</th><th class="p-2 text-left">Contato</th><th></th></tr></thead>
-            <tbody>
-              {% for g in gs %}
-              <tr class="border-t">
-                <td class="p-2">{{ g.name }}</td>
-                <td class="p-2">{{ g.document or '-' }}</td>
-                <td class="p-2">{{ g.phone or '-' }} {{ g.email or '' }}</td>
-                <td class="p-2"><a class="underline" href="{{ url_for('edit_guest', guest_id=g.id) }}">Editar</a></td>
-              </tr>
-              {% else %}
-              <tr><td class="p-2" colspan="4">Sem registros.</td></tr>
-              {% endfor %}
-            </tbody>
-          </table>
-        </div>
-        """,
-        gs=gs,
-    )
-    return render_template_string(BASE_HTML, content=content)
+        base = base.filter(guest_search_filter(q))
+    # Consumido pelo template em lotes de 50, sem materializar a lista inteira
+    gs = base.order_by(Guest.name.asc()).limit(200).yield_per(50)
+
+    return stream_page("guests.html", guests=gs, q=q)
 
 @app.route("/hospedes/novo", methods=["GET", "POST"])
 def new_guest():
@@ -364,22 +636,11 @@ def new_guest():
         )
         db.session.add(g)
         db.session.commit()
+        invalidate("form:guests")
         flash("Hóspede cadastrado.")
         # CORREÇÃO: Redireciona para a página do hóspede recém-criado ou para a lista de hóspedes
         return redirect(url_for("guests"))
-    content = render_template_string(
-        """
-        <h1 class="text-xl font-semibold mb-4">Novo hóspede</h1>
-        <form method="post" class="bg-white p-4 rounded-2xl shadow grid gap-3 md:w-2/3">
-          <input name="name" required placeholder="Nome completo" class="px-3 py-2 border rounded-xl">
-          <input name="document" placeholder="Documento (CPF/RG/Passaporte)" class="px-3 py-2 border rounded-xl">
-          <input name="phone" placeholder="Telefone" class="px-3 py-2 border rounded-xl">
-          <input name="email" placeholder="E-mail" class="px-3 py-2 border rounded-xl">
-          <button class="px-3 py-2 bg-slate-900 text-white rounded-xl">Salvar</button>
-        </form>
-        """
-    )
-    return render_template_string(BASE_HTML, content=content)
+    return render_template("guest_form.html", title="Novo hóspede", guest=None)
 
 @app.route("/hospedes/<int:guest_id>/editar", methods=["GET", "POST"])
 def edit_guest(guest_id: int):
@@ -390,61 +651,31 @@ def edit_guest(guest_id: int):
         g.phone = request.form.get("phone", "").strip() or None
         g.email = request.form.get("email", "").strip() or None
         db.session.commit()
+        invalidate("form:guests")
+        invalidate("dash:*")  # nome do hóspede aparece nos próximos check-ins
         flash("Hóspede atualizado.")
         return redirect(url_for("guests"))
-    content = render_template_string(
-        """
-        <h1 class="text-xl font-semibold mb-4">Editar hóspede</h1>
-        <form method="post" class="bg-white p-4 rounded-2xl shadow grid gap-3 md:w-2/3">
-          <input name="name" value="{{ g.name }}" required class="px-3 py-2 border rounded-xl">
-          <input name="document" value="{{ g.document or '' }}" class="px-3 py-2 border rounded-xl">
-          <input name="phone" value="{{ g.phone or '' }}" class="px-3 py-2 border rounded-xl">
-          <input name="email" value="{{ g.email or '' }}" class="px-3 py-2 border rounded-xl">
-          <button class="px-3 py-2 bg-slate-900 text-white rounded-xl">Salvar</button>
-        </form>
-        """,
-        g=g,
-    )
-    return render_template_string(BASE_HTML, content=content)
+    return render_template("guest_form.html", title="Editar hóspede", guest=g)
 
 # -------------------------- Reservas --------------------------
 @app.route("/reservas")
 def bookings():
     status = request.args.get("status", "")
-    base = Booking.query
+    # Tuplas com as colunas da listagem: evita hidratar Booking e os lazy loads de room/guest
+    base = (
+        db.session.query(
+            Booking.id, Booking.check_in, Booking.check_out, Booking.status, Booking.total_amount,
+            Room.number.label("room_number"), Guest.name.label("guest_name"),
+        )
+        .join(Room, Booking.room_id == Room.id)
+        .join(Guest, Booking.guest_id == Guest.id)
+    )
     if status:
         base = base.filter(Booking.status == status)
-    bs = base.order_by(Booking.check_in.desc()).limit(200).all()
-
-    content = render_template_string(
-        """
-        <div class="flex items-center mb-4">
-          <h1 class="text-xl font-semibold">Reservas</h1>
-          <a href="{{ url_for('new_booking') }}" class="ml-auto inline-block px-3 py-2 bg-slate-900 text-white rounded-xl shadow">Nova reserva</a>
-        </div>
-        <div class="bg-white shadow rounded-2xl overflow-hidden">
-          <table class="w-full text-sm">
-            <thead class="bg-slate-100"><tr><th class="p-2 text-left">Período</th><th class="p-2 text-left">Quarto</th><th class="p-2 text-left">Hóspede</th><th class="p-2 text-left">Status</th><th class="p-2 text-right">Total</th><th></th></tr></thead>
-            <tbody>
-              {% for b in bs %}
-              <tr class="border-t">
-                <td class="p-2">{{ b.check_in.strftime('%d/%m/%Y') }} → {{ b.check_out.strftime('%d/%m/%Y') }}</td>
-                <td class="p-2">{{ b.room.number }}</td>
-                <td class="p-2">{{ b.guest.name }}</td>
-                <td class="p-2">{{ b.status }}</td>
-                <td class="p-2 text-right">R$ {{ '%.2f'|format(b.total_amount) }}</td>
-                <td class="p-2"><a class="underline" href="{{ url_for('booking_detail', booking_id=b.id) }}">Abrir</a></td>
-              </tr>
-              {% else %}
-              <tr><td class="p-2" colspan="6">Sem reservas.</td></tr>
-              {% endfor %}
-            </tbody>
-          </table>
-        </div>
-        """,
-        bs=bs,
-    )
-    return render_template_string(BASE_HTML, content=content)
+    # Consumido pelo template em lotes de 50, sem materializar a lista inteira
+    bs = base.order_by(Booking.check_in.desc()).limit(200).yield_per(50)
+
+    return stream_page("bookings.html", bookings=bs)
 
 # CORREÇÃO: Esta é a função para criar uma NOVA reserva. A rota duplicada foi removida.
 @app.route("/reservas/nova", methods=["GET", "POST"])
@@ -453,66 +684,45 @@ def new_booking(room_id: int | None = None):
     if request.method == "POST":
         room_id_form = int(request.form["room_id"])
         guest_id = int(request.form["guest_id"])
-        check_in = datetime.strptime(request.form["check_in"], "%Y-%m-%d").date()
-        check_out = datetime.strptime(request.form["check_out"], "%Y-%m-%d").date()
+        check_in = parse_date(request.form["check_in"])
+        check_out = parse_date(request.form["check_out"])
         notes = request.form.get("notes")
 
+        if check_in is None or check_out is None:
+            flash("Datas inválidas.")
+            return redirect(request.url)
+
         if check_out <= check_in:
             flash("Data de check-out deve ser após check-in")
             return redirect(request.url)
 
-        conflict = Booking.query.filter(
-            Booking.room_id == room_id_form,
-            Booking.status.in_(["reservado", "checkin"]),
-            Booking.check_in < check_out,
-            Booking.check_out > check_in,
-        ).first()
+        rate = room_rate(room_id_form)
+        if rate is None:
+            flash("Quarto inválido.")
+            return redirect(request.url)
+
+        conflict = conflicting_guest(room_id_form, check_in, check_out)
         if conflict:
-            flash(f"Conflito: quarto já reservado/ocupado por {conflict.guest.name} nesse período.")
+            flash(f"Conflito: quarto já reservado/ocupado por {conflict} nesse período.")
             return redirect(url_for("new_booking", room_id=room_id_form))
 
         b = Booking(
             room_id=room_id_form, guest_id=guest_id, check_in=check_in, check_out=check_out,
-            status="reservado", notes=notes
+            status="reservado", notes=notes, rate=rate
         )
         b.total_amount = b.compute_amount()
         db.session.add(b)
         db.session.commit()
+        bookings_changed()
         flash("Reserva criada.")
         return redirect(url_for("booking_detail", booking_id=b.id))
 
-    rooms = Room.query.order_by(Room.number.asc()).all()
-    guests = Guest.query.order_by(Guest.name.asc()).all()
-    content = render_template_string(
-        """
-        <h1 class="text-xl font-semibold mb-4">Nova reserva</h1>
-        <form method="post" class="bg-white p-4 rounded-2xl shadow grid gap-3 md:w-2/3">
-          <label class="text-sm">Quarto
-            <select name="room_id" class="px-3 py-2 border rounded-xl w-full">
-              {% for r in rooms %}
-                <option value="{{ r.id }}" {% if pre_room_id==r.id %}selected{% endif %}>{{ r.number }} ({{ r.room_type }}) – R$ {{ '%.2f'|format(r.rate) }}</option>
-              {% endfor %}
-            </select>
-          </label>
-          <label class="text-sm">Hóspede
-            <select name="guest_id" class="px-3 py-2 border rounded-xl w-full">
-              {% for g in guests %}
-                <option value="{{ g.id }}">{{ g.name }}{% if g.document %} ({{ g.document }}){% endif %}</option>
-              {% endfor %}
-            </select>
-          </label>
-          <div class="grid md:grid-cols-2 gap-3">
-            <label class="text-sm">Check-in <input type="date" name="check_in" value="{{ now.strftime('%Y-%m-%d') }}" class="px-3 py-2 border rounded-xl w-full"></label>
-            <label class="text-sm">Check-out <input type="date" name="check_out" value="{{ (now + timedelta(days=1)).strftime('%Y-%m-%d') }}" class="px-3 py-2 border rounded-xl w-full"></label>
-          </div>
-          <textarea name="notes" placeholder="Observações" class="px-3 py-2 border rounded-xl"></textarea>
-          <button class="px-3 py-2 bg-slate-900 text-white rounded-xl">Criar reserva</button>
-        </form>
-        <p class="text-sm mt-3">Precisa cadastrar o hóspede? <a class="underline" href="{{ url_for('new_guest') }}">Clique aqui</a>.</p>
-        """,
-        rooms=rooms, guests=guests, pre_room_id=room_id, timedelta=timedelta
+    rooms = all_rooms_cached()
+    guests = all_guests_cached()
+    return render_template(
+        "booking_form.html", title="Nova reserva", booking=None, rooms=rooms, guests=guests,
+        pre_room_id=room_id, timedelta=timedelta,
     )
-    return render_template_string(BASE_HTML, content=content)
 
 
 # CORREÇÃO: Esta é a nova função para EDITAR uma reserva existente.
@@ -522,212 +732,273 @@ def booking_edit(booking_id: int):
     if request.method == "POST":
         room_id = int(request.form["room_id"])
         guest_id = int(request.form["guest_id"])
-        check_in = datetime.strptime(request.form["check_in"], "%Y-%m-%d").date()
-        check_out = datetime.strptime(request.form["check_out"], "%Y-%m-%d").date()
+        check_in = parse_date(request.form["check_in"])
+        check_out = parse_date(request.form["check_out"])
         notes = request.form.get("notes")
 
+        if check_in is None or check_out is None:
+            flash("Datas inválidas.")
+            return redirect(request.url)
+
         if check_out <= check_in:
             flash("Data de check-out deve ser após check-in.")
             return redirect(request.url)
 
         # Verifica conflito com OUTRAS reservas
-        conflict = Booking.query.filter(
-            Booking.id != booking_id, # Ignora a própria reserva
-            Booking.room_id == room_id,
-            Booking.status.in_(["reservado", "checkin"]),
-            Booking.check_in < check_out,
-            Booking.check_out > check_in,
-        ).first()
+        conflict = conflicting_guest(room_id, check_in, check_out, exclude_id=booking_id)  # Ignora a própria reserva
         if conflict:
-            flash(f"Conflito: quarto já reservado/ocupado por {conflict.guest.name} nesse período.")
+            flash(f"Conflito: quarto já reservado/ocupado por {conflict} nesse período.")
             return redirect(request.url)
 
+        if room_id != b.room_id:
+            # Troca de quarto: passa a valer a diária do novo quarto
+            rate = room_rate(room_id)
+            if rate is None:
+                flash("Quarto inválido.")
+                return redirect(request.url)
+            b.rate = rate
+
+        # Reserva em andamento ou finalizada: retira a contribuição antiga dos agregados antes de recalcular
+        apply_booking_effect(b.check_in, b.check_out, b.status, b.total_amount, -1)
         b.room_id = room_id
         b.guest_id = guest_id
         b.check_in = check_in
         b.check_out = check_out
         b.notes = notes
         b.total_amount = b.compute_amount()
+        apply_booking_effect(b.check_in, b.check_out, b.status, b.total_amount, 1)
         db.session.commit()
+        bookings_changed()
         flash("Reserva atualizada.")
         return redirect(url_for("booking_detail", booking_id=b.id))
 
-    rooms = Room.query.order_by(Room.number.asc()).all()
-    guests = Guest.query.order_by(Guest.name.asc()).all()
-    content = render_template_string(
-        """
-        <h1 class="text-xl font-semibold mb-4">Editar reserva #{{ b.id }}</h1>
-        <form method="post" class="bg-white p-4 rounded-2xl shadow grid gap-3 md:w-2/3">
-          <label class="text-sm">Quarto
-            <select name="room_id" class="px-3 py-2 border rounded-xl w-full">
-              {% for r in rooms %}
-                <option value="{{ r.id }}" {% if b.room_id==r.id %}selected{% endif %}>{{ r.number }} ({{ r.room_type }}) – R$ {{ '%.2f'|format(r.rate) }}</option>
-              {% endfor %}
-            </select>
-          </label>
-          <label class="text-sm">Hóspede
-            <select name="guest_id" class="px-3 py-2 border rounded-xl w-full">
-              {% for g in guests %}
-                <option value="{{ g.id }}" {% if b.guest_id==g.id %}selected{% endif %}>{{ g.name }}</option>
-              {% endfor %}
-            </select>
-          </label>
-          <div class="grid md:grid-cols-2 gap-3">
-            <label class="text-sm">Check-in <input type="date" name="check_in" value="{{ b.check_in.strftime('%Y-%m-%d') }}" class="px-3 py-2 border rounded-xl w-full"></label>
-            <label class="text-sm">Check-out <input type="date" name="check_out" value="{{ b.check_out.strftime('%Y-%m-%d') }}" class="px-3 py-2 border rounded-xl w-full"></label>
-          </div>
-          <textarea name="notes" class="px-3 py-2 border rounded-xl">{{ b.notes or '' }}</textarea>
-          <button class="px-3 py-2 bg-slate-900 text-white rounded-xl">Salvar</button>
-        </form>
-        """,
-        b=b, rooms=rooms, guests=guests
+    rooms = all_rooms_cached()
+    guests = all_guests_cached()
+    return render_template(
+        "booking_form.html", title=f"Editar reserva #{b.id}", booking=b, rooms=rooms, guests=guests,
+        timedelta=timedelta,
     )
-    return render_template_string(BASE_HTML, content=content)
 
 
 @app.route("/reservas/<int:booking_id>")
 def booking_detail(booking_id: int):
-    b = Booking.query.get_or_404(booking_id)
-    content = render_template_string(
-        """
-        <div class="flex items-center mb-4">
-          <h1 class="text-xl font-semibold">Reserva #{{ b.id }} – Quarto {{ b.room.number }}</h1>
-          <a href="{{ url_for('bookings') }}" class="ml-auto underline">Voltar</a>
-        </div>
-        <div class="bg-white rounded-2xl shadow p-4 grid gap-3">
-          <div class="grid md:grid-cols-4 gap-3">
-            <div><div class="text-sm opacity-60">Hóspede</div><div class="font-semibold">{{ b.guest.name }}</div></div>
-            <div><div class="text-sm opacity-60">Período</div><div class="font-semibold">{{ b.check_in.strftime('%d/%m/%Y') }} → {{ b.check_out.strftime('%d/%m/%Y') }} ({{ b.nights() }} noites)</div></div>
-            <div><div class="text-sm opacity-60">Status</div><div class="font-semibold">{{ b.status }}</div></div>
-            <div><div class="text-sm opacity-60">Total</div><div class="font-semibold">R$ {{ '%.2f'|format(b.total_amount) }}</div></div>
-          </div>
-          <div class="flex gap-2">
-            {% if b.status == 'reservado' %}
-              <a href="{{ url_for('booking_checkin', booking_id=b.id) }}" class="px-3 py-2 bg-blue-600 text-white rounded-xl">Fazer check-in</a>
-              <a href="{{ url_for('booking_cancel', booking_id=b.id) }}" class="px-3 py-2 bg-red-600 text-white rounded-xl">Cancelar</a>
-            {% elif b.status == 'checkin' %}
-              <a href="{{ url_for('booking_checkout', booking_id=b.id) }}" class="px-3 py-2 bg-emerald-600 text-white rounded-xl">Fazer check-out</a>
-            {% endif %}
-            <a href="{{ url_for('booking_edit', booking_id=b.id) }}" class="px-3 py-2 bg-slate-900 text-white rounded-xl">Editar</a>
-          </div>
-          {% if b.notes %}<div class="pt-2 border-t mt-2"><div class="text-sm opacity-60">Observações</div><div>{{ b.notes }}</div></div>{% endif %}
-        </div>
-        """,
-        b=b,
-    )
-    return render_template_string(BASE_HTML, content=content)
-
-@app.route("/reservas/<int:booking_id>/checkin")
+    b = Booking.query.options(joinedload(Booking.room), joinedload(Booking.guest)).get_or_404(booking_id)
+    return render_template("booking_detail.html", b=b)
+
+def booking_transition(booking_id: int, allowed: list[str], **values):
+    # UPDATE condicional: checagem do status e escrita no mesmo comando, sem SELECT prévio
+    return db.session.execute(
+        update(Booking)
+        .where(Booking.id == booking_id, Booking.status.in_(allowed))
+        .values(**values)
+        .returning(Booking.check_in, Booking.check_out, Booking.total_amount)
+        .execution_options(synchronize_session=False)
+    ).first()
+
+def apply_transition(booking_id: int, action: str, d: date) -> bool:
+    # Aplica a transição e atualiza os agregados na sessão atual, sem commit;
+    # retorna False se o status não permitir
+    if action == "checkin":
+        row = booking_transition(booking_id, ["reservado"], status="checkin")
+        if row is not None:
+            apply_booking_effect(row.check_in, row.check_out, "checkin", row.total_amount, 1)
+    elif action == "checkout":
+        # A saída prevista é substituída pela data real: precisa do período antigo para os agregados
+        before = (
+            db.session.query(Booking.check_in, Booking.check_out)
+            .filter(Booking.id == booking_id, Booking.status == "checkin")
+            .first()
+        )
+        if before is None:
+            return False
+        check_out = literal(d, db.Date)  # Opcional: ajustar a data de checkout para o dia atual
+        row = booking_transition(
+            booking_id, ["checkin"],
+            status="checkout", check_out=check_out, total_amount=Booking.rate * sql_nights(Booking.check_in, check_out),
+        )
+        if row is not None:
+            apply_booking_effect(before.check_in, before.check_out, "checkin", 0, -1)
+            apply_booking_effect(row.check_in, row.check_out, "checkout", row.total_amount, 1)
+    else:
+        row = booking_transition(booking_id, ["checkin"], status="cancelado")
+        if row is not None:
+            apply_booking_effect(row.check_in, row.check_out, "checkin", row.total_amount, -1)
+        else:
+            row = booking_transition(booking_id, ["reservado"], status="cancelado")
+    return row is not None
+
+# Escritor em segundo plano: agrupa as transições pendentes e faz um único commit por lote,
+# diluindo o custo do fsync entre requisições concorrentes.
+TRANSITION_TIMEOUT = 10  # segundos que a requisição espera pela confirmação do lote
+TRANSITION_PENDING = "Operação em processamento. Confira o status da reserva em instantes."
+_transition_queue: queue.Queue = queue.Queue()
+_transition_writer: threading.Thread | None = None
+_transition_writer_lock = threading.Lock()
+
+def begin_batch() -> None:
+    # O driver sqlite3 só abre a transação no primeiro INSERT/UPDATE: sem um BEGIN explícito o
+    # primeiro SAVEPOINT viraria a própria transação e cada RELEASE faria commit sozinho.
+    # IMMEDIATE já reserva a escrita, que o lote vai fazer de qualquer forma.
+    if IS_SQLITE:
+        db.session.connection().exec_driver_sql("BEGIN IMMEDIATE")
+
+def transition_writer_loop() -> None:
+    with app.app_context():
+        while True:
+            batch = [_transition_queue.get()]
+            while True:
+                try:
+                    batch.append(_transition_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                begin_batch()
+            except Exception as exc:
+                db.session.rollback()
+                for future, *_ in batch:
+                    future.set_exception(exc)
+                continue
+            # Cada transição em um SAVEPOINT: uma falha desfaz só a própria, o resto do lote segue
+            applied, failed = [], []
+            for future, booking_id, action, d in batch:
+                try:
+                    with db.session.begin_nested():
+                        applied.append((future, apply_transition(booking_id, action, d)))
+                except Exception as exc:
+                    failed.append((future, exc))
+            try:
+                db.session.commit()
+            except Exception as exc:
+                db.session.rollback()
+                applied, failed = [], failed + [(future, exc) for future, _ in applied]
+            if any(ok for _, ok in applied):
+                bookings_changed()
+            for future, ok in applied:
+                future.set_result(ok)
+            for future, exc in failed:
+                future.set_exception(exc)
+
+def submit_transition(booking_id: int, action: str) -> bool | None:
+    # None: o lote não confirmou a tempo (a transição segue na fila e ainda pode ser aplicada)
+    global _transition_writer
+    with _transition_writer_lock:
+        if _transition_writer is None:
+            _transition_writer = threading.Thread(target=transition_writer_loop, name="transition-writer", daemon=True)
+            _transition_writer.start()
+    future: Future = Future()
+    _transition_queue.put((future, booking_id, action, today()))
+    try:
+        return future.result(timeout=TRANSITION_TIMEOUT)
+    except FutureTimeoutError:
+        return None
+
+@app.route("/reservas/<int:booking_id>/checkin", methods=["POST"])
 def booking_checkin(booking_id: int):
-    b = Booking.query.get_or_404(booking_id)
-    if b.status != "reservado":
+    check_csrf()
+    ok = submit_transition(booking_id, "checkin")
+    if ok is None:
+        flash(TRANSITION_PENDING)
+        return redirect(url_for("booking_detail", booking_id=booking_id))
+    if not ok:
+        Booking.query.get_or_404(booking_id)
         flash("Operação inválida. Apenas reservas com status 'reservado' podem fazer check-in.")
-        return redirect(url_for("booking_detail", booking_id=b.id))
-    b.status = "checkin"
-    db.session.commit()
+        return redirect(url_for("booking_detail", booking_id=booking_id))
     flash("Check-in realizado.")
-    return redirect(url_for("booking_detail", booking_id=b.id))
+    return redirect(url_for("booking_detail", booking_id=booking_id))
 
-@app.route("/reservas/<int:booking_id>/checkout")
+@app.route("/reservas/<int:booking_id>/checkout", methods=["POST"])
 def booking_checkout(booking_id: int):
-    b = Booking.query.get_or_404(booking_id)
-    if b.status != "checkin":
+    check_csrf()
+    ok = submit_transition(booking_id, "checkout")
+    if ok is None:
+        flash(TRANSITION_PENDING)
+        return redirect(url_for("booking_detail", booking_id=booking_id))
+    if not ok:
+        Booking.query.get_or_404(booking_id)
         flash("Operação inválida. Apenas hóspedes com status 'checkin' podem fazer check-out.")
-        return redirect(url_for("booking_detail", booking_id=b.id))
-    b.check_out = today() # Opcional: ajustar a data de checkout para o dia atual
-    b.total_amount = b.compute_amount()
-    b.status = "checkout"
-    db.session.commit()
+        return redirect(url_for("booking_detail", booking_id=booking_id))
     flash("Check-out realizado.")
-    return redirect(url_for("booking_detail", booking_id=b.id))
+    return redirect(url_for("booking_detail", booking_id=booking_id))
 
-@app.route("/reservas/<int:booking_id>/cancelar")
+@app.route("/reservas/<int:booking_id>/cancelar", methods=["POST"])
 def booking_cancel(booking_id: int):
-    b = Booking.query.get_or_404(booking_id)
-    if b.status in ("checkout", "cancelado"):
+    check_csrf()
+    ok = submit_transition(booking_id, "cancelar")
+    if ok is None:
+        flash(TRANSITION_PENDING)
+        return redirect(url_for("booking_detail", booking_id=booking_id))
+    if not ok:
+        Booking.query.get_or_404(booking_id)
         flash("Operação inválida. Esta reserva já foi finalizada ou cancelada.")
-        return redirect(url_for("booking_detail", booking_id=b.id))
-    b.status = "cancelado"
-    db.session.commit()
+        return redirect(url_for("booking_detail", booking_id=booking_id))
     flash("Reserva cancelada.")
-    return redirect(url_for("booking_detail", booking_id=b.id))
+    return redirect(url_for("booking_detail", booking_id=booking_id))
 
 # -------------------------- Relatórios --------------------------
 # CORREÇÃO: Função de relatórios completada e com lógica de cálculo de ocupação corrigida.
 @app.route("/relatorios", methods=["GET", "POST"])
 def reports():
-    start_str = request.form.get("d1") if request.method == "POST" else request.args.get("d1")
-    end_str = request.form.get("d2") if request.method == "POST" else request.args.get("d2")
+    src = request.form if request.method == "POST" else request.args
+    start_str, end_str = src.get("d1"), src.get("d2")
 
+    # Padrão: mês atual (também quando o período informado é inválido)
+    start_date, end_date = g.month_bounds
     if start_str and end_str:
-        try:
-            start_date = datetime.strptime(start_str, "%Y-%m-%d").date()
-            end_date = datetime.strptime(end_str, "%Y-%m-%d").date()
-            if end_date <= start_date:
-                flash("Data final deve ser maior que data inicial")
-                start_date, end_date = None, None # Reset
-        except ValueError:
+        d1, d2 = parse_date(start_str), parse_date(end_str)
+        if d1 is None or d2 is None:
             flash("Datas inválidas")
-            start_date, end_date = None, None # Reset
-    else:
-        # Padrão: mês atual
-        t = today()
-        start_date = t.replace(day=1)
-        end_date = (start_date + timedelta(days=32)).replace(day=1)
-
-    total_revenue = Decimal("0.00")
-    occupation_rate = 0.0
-    
-    if start_date and end_date:
-        # Receita no período (baseado na data de check-out)
-        total_revenue = db.session.query(func.coalesce(func.sum(Booking.total_amount), 0)).filter(
-            Booking.status == "checkout", Booking.check_out >= start_date, Booking.check_out < end_date
-        ).scalar() or Decimal("0.00")
+        elif d2 <= d1:
+            flash("Data final deve ser maior que data inicial")
+        else:
+            start_date, end_date = d1, d2
+
+    total_revenue, occupation_rate = 0.0, 0.0
+
+    # Capacidade do período: sem quartos (ou sem dias) não há receita nem ocupação a consultar
+    period_days = (end_date - start_date).days
+    total_rooms = get_total_rooms()
+    total_room_nights_available = period_days * total_rooms
+
+    if total_room_nights_available > 0:
+        # Receita (pela data de check-out) e noites ocupadas em um único SELECT (subconsultas escalares).
+        # Mês fechado (o padrão): receita de uma linha do agregado mensal; outros períodos: soma do
+        # agregado diário. Receita lida direto como float, que é o que o template formata.
+        in_period = and_(DailyOccupancy.day >= start_date, DailyOccupancy.day < end_date)
+        if start_date.day == 1 and end_date == month_bounds(start_date)[1]:
+            revenue = db.session.query(func.coalesce(func.sum(RevenueByMonth.revenue), 0.0)).filter(
+                RevenueByMonth.year == start_date.year, RevenueByMonth.month == start_date.month
+            )
+        else:
+            revenue = db.session.query(func.coalesce(func.sum(DailyOccupancy.revenue), 0.0)).filter(in_period)
+        occupied = db.session.query(func.coalesce(func.sum(DailyOccupancy.rooms_occupied), 0)).filter(in_period)
+        occupied_nights, total_revenue = db.session.query(
+            occupied.scalar_subquery(), type_coerce(revenue.scalar_subquery(), db.Float)
+        ).one()
 
         # Taxa de ocupação: (noites ocupadas no período) / (quartos * dias no período)
-        period_days = (end_date - start_date).days
-        total_rooms = Room.query.count()
-        total_room_nights_available = period_days * total_rooms
-        
-        occupied_nights = 0
-        if total_room_nights_available > 0:
-            # Encontra todas as reservas que se sobrepõem ao período
-            overlapping_bookings = Booking.query.filter(
-                Booking.status.in_(["checkin", "checkout"]),
-                Booking.check_in < end_date,
-                Booking.check_out > start_date,
-            ).all()
-
-            for b in overlapping_bookings:
-                # Calcula a interseção da reserva com o período do relatório
-                overlap_start = max(b.check_in, start_date)
-                overlap_end = min(b.check_out, end_date)
-                occupied_nights += (overlap_end - overlap_start).days
-            
-            occupation_rate = (occupied_nights / total_room_nights_available) * 100 if total_room_nights_available > 0 else 0
-
-    content = render_template_string(
-        """
-        <h1 class="text-xl font-semibold mb-4">Relatórios</h1>
-        <form method="post" class="bg-white p-4 rounded-2xl shadow grid md:grid-cols-3 gap-3 items-end">
-            <label class="text-sm">Data inicial <input type="date" name="d1" value="{{ start.strftime('%Y-%m-%d') }}" class="px-3 py-2 border rounded-xl w-full"></label>
-            <label class="text-sm">Data final <input type="date" name="d2" value="{{ end.strftime('%Y-%m-%d') }}" class="px-3 py-2 border rounded-xl w-full"></label>
-            <button class="px-3 py-2 bg-slate-900 text-white rounded-xl h-fit">Gerar</button>
-        </form>
-        <div class="mt-6 grid md:grid-cols-2 gap-4">
-            <div class="p-4 rounded-2xl bg-white shadow">
-                <div class="text-sm opacity-70">Receita no período</div>
-                <div class="text-3xl font-bold">R$ {{ '%.2f'|format(revenue) }}</div>
-            </div>
-            <div class="p-4 rounded-2xl bg-white shadow">
-                <div class="text-sm opacity-70">Taxa de ocupação média</div>
-                <div class="text-3xl font-bold">{{ '%.2f'|format(rate) }}%</div>
-            </div>
-        </div>
-        """,
-        start=start_date, end=end_date, revenue=float(total_revenue), rate=occupation_rate
-    )
-    return render_template_string(BASE_HTML, content=content)
+        occupation_rate = (occupied_nights / total_room_nights_available) * 100
+
+    # Mesmo período e mesmos números (no mesmo dia, que aparece no menu) => mesma página
+    etag = hashlib.blake2b(
+        f"{g.today}|{start_date}|{end_date}|{total_revenue}|{occupation_rate}".encode(), digest_size=8
+    ).hexdigest()
+    # Mensagens pendentes só saem no corpo da página: nesse caso renderiza sempre
+    if request.method == "GET" and not get_flashed_messages() and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render_template(
+            "reports.html", start=start_date, end=end_date, revenue=total_revenue, rate=occupation_rate
+        ))
+    response.set_etag(etag)
+    if request.method == "GET":
+        response.cache_control.private = True
+        if end_date <= g.today:
+            # Período já encerrado: vale até a virada do dia
+            midnight = datetime.combine(g.today + timedelta(days=1), datetime.min.time(), tzinfo=APP_TZ)
+            response.cache_control.max_age = int((midnight - g.now).total_seconds())
+        else:
+            response.cache_control.no_cache = True
+    return response
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0")
\ No newline at end of file